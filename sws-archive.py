@@ -8,6 +8,7 @@ from dateutil.relativedelta import relativedelta
 import re
 import lzma
 import shutil
+import sws_profile
 
 def vprint(*args, **kwargs):
     if verbose:
@@ -15,10 +16,13 @@ def vprint(*args, **kwargs):
 
 def archive(s, month):
     fname = ifile + f'.{month.year}-{month.month:02d}.xz'
-    f = open(fname, 'wb')
     vprint(f'Compressing {fname}')
-    f.write(lzma.compress(s.encode('utf-8')))
-    f.close()
+    with profiler.stage('compress'):
+        data = lzma.compress(s.encode('utf-8'))
+    with profiler.stage('write'):
+        f = open(fname, 'wb')
+        f.write(data)
+        f.close()
 
 def main():
     parser = argparse.ArgumentParser(description='Archive Meteodata file')
@@ -33,11 +37,19 @@ def main():
     parser.add_argument('-b', '--backup', action='store_true',
                         help='backup original file')
 
+    parser.add_argument('--profile', metavar='REPORT',
+                        help="write per stage time report as JSON ('-' for stderr)")
+    parser.add_argument('--profile-memory', action='store_true',
+                        help="also report per stage peak memory with --profile (much slower)")
+    parser.add_argument('--cprofile', metavar='FILE',
+                        help="write cProfile statistics to FILE")
     parser.add_argument('ifile', help='input file')
     args = parser.parse_args()
 
     global verbose
     global ifile
+    global profiler
+    profiler = sws_profile.from_args(args)
     verbose = args.verbose
     ifile = args.ifile
 
@@ -52,7 +64,8 @@ def main():
     next_working_month = None
     out = ''
 
-    with open(ifile, 'r', encoding='utf-8') as f:
+    # Read and parse in a single pass, archive() stages are accounted apart
+    with open(ifile, 'r', encoding='utf-8') as f, profiler.stage('parse'):
         l = re.compile(r'(?P<date>\d{4}-\d\d-\d\d) (\d\d:\d\d)\s*(\d* \d)\s*(-?\d*.\d)C (\d*)%')
         for line in f:
             if line[0] == '#':
@@ -88,9 +101,10 @@ def main():
             out+= line
 
     f.close()
-    f = open(ifile, 'w', encoding='utf-8')
-    f.write(out)
-    f.close()
+    with profiler.stage('write'):
+        f = open(ifile, 'w', encoding='utf-8')
+        f.write(out)
+        f.close()
 
 
 if __name__ == '__main__':
@@ -3,9 +3,14 @@
 # Copyright (c) 2024 Jerome Marchand
 
 import argparse
+import ctypes
 import datetime as dt
+import os
 import re
+import select
 import socket
+import struct
+import sws_profile
 
 verbose = False
 
@@ -13,6 +18,8 @@ def vprint(*args, **kwargs):
     if verbose:
         print(*args, **kwargs)
 
+profiler = sws_profile.Profiler()
+
 def convertFtoC(temp):
     return round((temp - 32) / 1.8, 1)
 
@@ -35,20 +42,27 @@ def read_socket():
 def read_file(ifile):
     return open(ifile, 'r', encoding="utf-8").read()
 
-def process_message(m, sensors, configsensors):
-    l = re.compile(r'(\d{4}-\d\d-\d\d \d\d:\d\d)\s*(\d* \d)\s*(-?\d*.\d)([CF]) (\d*)%( (.*))?')
-    s = re.compile(r'(\d*) (\d)')
+line_re = re.compile(r'(\d{4}-\d\d-\d\d \d\d:\d\d)\s*(\d* \d)\s*(-?\d*.\d)([CF]) (\d*)%( (.*))?')
+sensor_re = re.compile(r'(\d*) (\d)')
+
+def process_message(m, sensors, configsensors, resident=False):
     for line in m.splitlines():
+        if resident and not line:
+            continue
         if line[0] == '#':
             # TODO: uses regex to allow blank char before '#'?
             continue
         vprint(f'Processing line: {line}')
-        m = l.match(line)
+        m = line_re.match(line)
+        if not m and resident:
+            # e.g. a truncated socket reply: don't let it kill the daemon
+            vprint(f"Skipping line that doesn't match: {line}")
+            continue
         if not m:
             print(f"Line doesn't match: {line}")
         sensor = m.group(2)
         if configsensors:
-            mm = s.match(sensor)
+            mm = sensor_re.match(sensor)
             sensorid = (mm.group(1), mm.group(2))
             if sensorid not in configsensors:
                 vprint(f'Skipping unknown sensor: {sensor}')
@@ -61,12 +75,210 @@ def process_message(m, sensors, configsensors):
 
         # Update the sensor if the data is more  recent
         # Prefer Celsius to Farenheit
-        if not (sensor in sensors) or (sensors[sensor]['time'] < time) or ((sensors[sensor]['time'] == time) and (sensors[sensor]['unit'] == 'F') and  (m.group(4) == 'C')):
+        # Within the same minute, the last reading of a unit wins
+        if not (sensor in sensors) or (sensors[sensor]['time'] < time) or ((sensors[sensor]['time'] == time) and (sensors[sensor]['unit'] == 'F' or sensors[sensor]['unit'] == m.group(4))):
             sensors[sensor] = {'temp':float(m.group(3)), 'unit':m.group(4),
                                'humidity':float(m.group(5)), 'time':time, 'low_power':m.group(7)}
 
     return sensors
 
+def read_config(configfile):
+    configsensors = {}
+    with open(configfile, 'r', encoding="utf-8") as f:
+        l = re.compile(r'\s*(\d*)\s*(\d)\s*(.*)\n?')
+        for line in f:
+            if line[0] == '#' or line == '\n':
+                # ignore comments or empty lines
+                continue
+            m = l.match(line)
+            if not m:
+                print(f"Line doesn't match \"{line}\"")
+            configsensors[(m.group(1), m.group(2))] = m.group(3);
+            vprint(f'Named sensor: {m.group(3)}')
+    return configsensors
+
+def render(sensors, configsensors, celcius, fahrenheit):
+    out = ["<table>"]
+    for sensor in configsensors.values():
+        fresh = False
+        vprint(f'Processing sensor: {sensor}')
+        if sensor not in sensors:
+            vprint(f'Missing data for sensor: {sensor}')
+            s = {'temp':' ----', 'unit':'?', 'humidity':'----', 'time':'----', 'low_power':''}
+        else:
+            s = sensors[sensor]
+            tl = dt.datetime.combine(dt.date.today(), dt.time()) - dt.timedelta(minutes=15)
+            if s['time'] > tl:
+                fresh = True
+        if s['low_power'] == "Low Power":
+            out.append("  <tr bgcolor=\"#FF9\">")
+        elif fresh:
+            out.append("  <tr>")
+        else:
+            out.append("  <tr bgcolor=\"#EDD\">")
+        if celcius and s['unit'] == 'F':
+            temp = convertFtoC(s['temp'])
+            unit = 'C'
+        elif fahrenheit and s['unit'] == 'C':
+            temp = convertCtoF(s['temp'])
+            unit = 'F'
+        else:
+            temp = s['temp']
+            unit =s['unit']
+        out.append(f"    <td>{sensor:10}:</td> <td>{temp:5}&deg;{unit}</td> <td>{s['humidity']:4} %</td> <td>{s['time']}</td>")
+        out.append("  </tr>")
+    out.append("</table>")
+    return "\n".join(out) + "\n"
+
+def write_output(output, html, atomic=False):
+    if not output:
+        print(html, end='', flush=True)
+        return
+    if not atomic:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(html)
+        return
+    # Write aside and rename, so that readers never see a partial table.
+    # Requires write access to the output directory.
+    tmp = output + '.tmp'
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(html)
+    os.replace(tmp, output)
+
+# inotify(7) constants
+IN_MODIFY      = 0x002
+IN_ATTRIB      = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVE_SELF   = 0x800
+IN_DELETE_SELF = 0x400
+IN_NONBLOCK    = os.O_NONBLOCK
+
+# Wait for changes of a file with inotify, or by polling its status
+# when inotify is not available
+class FileWatcher:
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.fd = None
+        self.wd = -1
+        self.stat = None
+        try:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            fd = self.libc.inotify_init1(IN_NONBLOCK)
+        except (OSError, AttributeError):
+            fd = -1
+        if fd < 0:
+            vprint('inotify not available: polling')
+        else:
+            self.fd = fd
+            self.add_watch()
+
+    def add_watch(self):
+        mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVE_SELF | IN_DELETE_SELF
+        self.wd = self.libc.inotify_add_watch(self.fd, os.fsencode(self.path), mask)
+
+    # Return True if the file may have changed within timeout seconds
+    def wait(self, timeout):
+        if self.fd is None or self.wd < 0:
+            # Polling, also used while the file is missing
+            if self.fd is not None:
+                self.add_watch()
+            timeout = min(timeout, self.interval)
+            select.select([], [], [], timeout)
+            try:
+                st = os.stat(self.path)
+                st = (st.st_ino, st.st_size, st.st_mtime_ns)
+            except FileNotFoundError:
+                st = None
+            changed = st != self.stat
+            self.stat = st
+            return changed
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if not r:
+            return False
+        try:
+            events = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return False
+        # Each event starts with wd(int), mask(uint32), cookie(uint32), len(uint32)
+        offset = 0
+        while offset < len(events):
+            _, mask, _, length = struct.unpack_from('iIII', events, offset)
+            if mask & (IN_MOVE_SELF | IN_DELETE_SELF):
+                # The file was replaced: watch the new one
+                self.libc.inotify_rm_watch(self.fd, self.wd)
+                self.add_watch()
+            offset += struct.calcsize('iIII') + length
+        return True
+
+# Read the lines appended to a file since the last call
+class FileFollower:
+    def __init__(self, path):
+        self.path = path
+        self.inode = None
+        self.offset = 0
+
+    def read(self):
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return ''
+        with f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != self.inode or st.st_size < self.offset:
+                # New or truncated (e.g. by sws-archive.py) file
+                vprint(f'Reading {self.path} from the start')
+                self.inode = st.st_ino
+                self.offset = 0
+            f.seek(self.offset)
+            data = f.read()
+        # Leave any incomplete line for the next time
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+        return data[:end].decode('utf-8')
+
+def seconds_to_midnight():
+    # Freshness only depends on the date, see render()
+    tomorrow = dt.datetime.combine(dt.date.today() + dt.timedelta(days=1), dt.time())
+    return (tomorrow - dt.datetime.now()).total_seconds() + 1
+
+def watch(args, configsensors):
+    sensors = {}
+    follower = None
+    watcher = None
+    if args.ifile:
+        follower = FileFollower(args.ifile)
+        watcher = FileWatcher(args.ifile, args.interval)
+    last = None
+    while True:
+        if args.socket:
+            try:
+                with profiler.stage('read'):
+                    m = read_socket()
+                with profiler.stage('parse'):
+                    sensors = process_message(m, sensors, configsensors, True)
+            except OSError as e:
+                vprint(f'Socket error: {e}')
+        if follower:
+            with profiler.stage('read'):
+                m = follower.read()
+            with profiler.stage('parse'):
+                sensors = process_message(m, sensors, configsensors, True)
+        with profiler.stage('render'):
+            html = render(sensors, configsensors, args.celcius, args.fahrenheit)
+        if html != last:
+            vprint('Table changed: update output')
+            with profiler.stage('write'):
+                write_output(args.output, html, atomic=True)
+            last = html
+        # The socket can't notify us, poll it
+        if watcher and not args.socket:
+            watcher.wait(seconds_to_midnight())
+        elif watcher:
+            watcher.wait(min(args.interval, seconds_to_midnight()))
+        else:
+            select.select([], [], [], min(args.interval, seconds_to_midnight()))
+
 def main():
     parser = argparse.ArgumentParser(description='Extract latest temperatures')
     parser.add_argument('-c', '--configfile',
@@ -79,70 +291,53 @@ def main():
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-C', '--celcius', action='store_true', help="converts to Celsius")
     group.add_argument('-F', '--fahrenheit', action='store_true', help="converts to Fahrenheit")
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help="keep running and update output when data change")
+    parser.add_argument('-i', '--interval', type=float, default=1,
+                        help="socket polling interval in seconds in watch mode (default: 1)")
+    parser.add_argument('--profile', metavar='REPORT',
+                        help="write per stage time report as JSON ('-' for stderr, also on SIGUSR1 with --watch)")
+    parser.add_argument('--profile-memory', action='store_true',
+                        help="also report per stage peak memory with --profile (much slower)")
+    parser.add_argument('--cprofile', metavar='FILE',
+                        help="write cProfile statistics to FILE")
     args = parser.parse_args()
 
     global verbose
     verbose = args.verbose
+    global profiler
+    profiler = sws_profile.from_args(args)
 
     if args.configfile:
-        configsensors = {}
-        with open(args.configfile, 'r', encoding="utf-8") as f:
-            l = re.compile(r'\s*(\d*)\s*(\d)\s*(.*)\n?')
-            for line in f:
-                if line[0] == '#' or line == '\n':
-                    # ignore comments or empty lines
-                    continue
-                m = l.match(line)
-                if not m:
-                    print(f"Line doesn't match \"{line}\"")
-                configsensors[(m.group(1), m.group(2))] = m.group(3);
-                vprint(f'Named sensor: {m.group(3)}')
+        configsensors = read_config(args.configfile)
     else:
         configsensors = None
 
+    if not args.socket and not args.ifile:
+        print("Error: no input\n")
+        exit();
+
+    if args.watch:
+        # Resident: allow to get the report without stopping
+        profiler.dump_on_signal()
+        watch(args, configsensors)
+
     sensors = {};
     if args.socket:
-        sensors = process_message(read_socket(), sensors, configsensors) 
+        with profiler.stage('read'):
+            m = read_socket()
+        with profiler.stage('parse'):
+            sensors = process_message(m, sensors, configsensors)
     if args.ifile:
-        sensors = process_message(read_file(args.ifile), sensors, configsensors)
-    elif not args.socket:
-        print("Error: no input\n")
-        exit();
+        with profiler.stage('read'):
+            m = read_file(args.ifile)
+        with profiler.stage('parse'):
+            sensors = process_message(m, sensors, configsensors)
 
-    if args.output:
-        f = open(args.output, "w", encoding="utf-8")
-    else:
-        f = None
-    print("<table>", file=f)
-    for sensor in configsensors.values():
-        fresh = False
-        vprint(f'Processing sensor: {sensor}')
-        if sensor not in sensors:
-            vprint(f'Missing data for sensor: {sensor}')
-            s = {'temp':' ----', 'unit':'?', 'humidity':'----', 'time':'----', 'low_power':''}
-        else:
-            s = sensors[sensor]
-            tl = dt.datetime.combine(dt.date.today(), dt.time()) - dt.timedelta(minutes=15)
-            if s['time'] > tl:
-                fresh = True
-        if s['low_power'] == "Low Power":
-            print("  <tr bgcolor=\"#FF9\">", file=f)
-        elif fresh:
-            print("  <tr>", file=f)
-        else:
-            print("  <tr bgcolor=\"#EDD\">", file=f)
-        if args.celcius and s['unit'] == 'F':
-            temp = convertFtoC(s['temp'])
-            unit = 'C'
-        elif args.fahrenheit and s['unit'] == 'C':
-            temp = convertCtoF(s['temp'])
-            unit = 'F'
-        else:
-            temp = s['temp']
-            unit =s['unit']
-        print(f"    <td>{sensor:10}:</td> <td>{temp:5}&deg;{unit}</td> <td>{s['humidity']:4} %</td> <td>{s['time']}</td>", file=f)
-        print("  </tr>", file=f)
-    print("</table>", file=f)
+    with profiler.stage('render'):
+        html = render(sensors, configsensors, args.celcius, args.fahrenheit)
+    with profiler.stage('write'):
+        write_output(args.output, html)
 
 if __name__ == '__main__':
     main()
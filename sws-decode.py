@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (c) 2024 Jerome Marchand
+
+# Decode pulse logs captured with tools/sws-th-sniff or tools/datalog
+# (see docs/Protocol.md) into sensor readings. The two tools don't use
+# the same symbols for impulse lengths, see --alphabet.
+
+import argparse
+import re
+import sys
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+verbose = False
+
+def vprint(*args, **kwargs):
+    if verbose:
+        print(*args, **kwargs)
+
+# Nominal impulse length (ms) of each symbol, see docs/Protocol.md
+PULSE_LENGTHS = np.array([250, 500, 750, 1000, 2000, 2450, 3000, 3400, 4000])
+INVALID = -1
+
+# Characters of each log format and the symbol above they stand for.
+# Any other character is an invalid impulse.
+ALPHABETS = {
+    # docs/Protocol.md, tools/sws-th-sniff
+    'protocol': {'0': 0, '1': 1, '2': 2, '3': 3, '4': 4, '5': 5, '6': 6,
+                 '7': 7, '8': 8},
+    # tools/datalog: 0 250, 1 500, 2 750, 3 1000, 4 1500, 5 2000,
+    # 6 2500, 7 3000, 8 4000, 9 5000, A 7500, B 10000
+    'datalog': {'0': 0, '1': 1, '2': 2, '3': 3, '5': 4, '6': 5, '7': 6,
+                '8': 8},
+}
+
+# Celsius dataframe: 31 -> 0, 41 -> 1, synced by 81
+SYNC1 = (8, 1)
+DATASZ1 = (36, 52)
+# Bits 24-27 of Celsius dataframes are always on
+CHECK1 = (24, 4, 0xf)
+# Fahrenheit dataframe: 01 -> 0, 10 -> 1, synced by 22222222
+SYNC2_LEN = 8
+DATASZ2 = 41
+
+# Frames of the same format closer than that (in impulses) belong to
+# the same burst of repeated frames
+BURST_GAP = 1024
+# Identifier, low power and channel bits, common to both formats
+SENSOR_BITS = 12
+
+marker = re.compile(rb'\?(\d+)\?')
+
+def classify(durations, tolerance):
+    # Map durations (ms) to the nearest symbol, INVALID if too far off
+    durations = np.asarray(durations, dtype=np.float64)
+    idx = np.abs(durations[:, None] - PULSE_LENGTHS[None, :]).argmin(axis=1)
+    ok = np.abs(durations - PULSE_LENGTHS[idx]) <= tolerance * PULSE_LENGTHS[idx]
+    return np.where(ok, idx, INVALID).astype(np.int8)
+
+def read_pulses(data, tolerance, alphabet):
+    # Turn the raw log into an array of symbols. Characters of the
+    # alphabet are symbols, ?xxx? markers are classified from their
+    # duration, any other character (Z, z, H, ., _ ...) is an invalid
+    # impulse and whitespace is dropped.
+    raw = np.frombuffer(data, dtype=np.uint8)
+    table = np.full(256, INVALID, dtype=np.int8)
+    for c, symbol in ALPHABETS[alphabet].items():
+        table[ord(c)] = symbol
+    symbols = table[raw]
+    keep = ~np.isin(raw, np.frombuffer(b' \t\r\n', dtype=np.uint8))
+
+    spans = np.array([(m.start(), m.end(), int(m.group(1)))
+                      for m in marker.finditer(data)], dtype=np.int64)
+    if len(spans):
+        vprint(f'{len(spans)} out of range markers')
+        starts, ends = spans[:, 0], spans[:, 1]
+        symbols[starts] = classify(spans[:, 2], tolerance)
+        # Drop everything but the first character of each marker
+        inside = np.zeros(len(raw) + 1, dtype=np.int64)
+        np.add.at(inside, starts + 1, 1)
+        np.add.at(inside, ends, -1)
+        keep &= np.cumsum(inside[:-1]) == 0
+
+    return symbols[keep]
+
+def pair_ok_cumsum(ok):
+    # Cumulative count of valid pairs for each parity, so that the
+    # validity of any run of pairs is checked in constant time
+    cs = np.zeros(len(ok) + 2, dtype=np.int64)
+    cs[2::2] = np.cumsum(ok[0::2])
+    cs[3::2] = np.cumsum(ok[1::2])
+    return cs
+
+def find_frames1(s):
+    # Frames sit between two consecutive 81 syncs
+    sync = np.flatnonzero((s[:-1] == SYNC1[0]) & (s[1:] == SYNC1[1]))
+    starts = sync[:-1] + 2
+    npulses = sync[1:] - starts
+    ok = np.zeros(len(s), dtype=bool)
+    ok[:-1] = ((s[:-1] == 3) | (s[:-1] == 4)) & (s[1:] == 1)
+    cs = pair_ok_cumsum(ok)
+    nbits = npulses // 2
+    valid = ((npulses % 2 == 0) &
+             (cs[starts + npulses] - cs[starts] == nbits) &
+             np.isin(nbits, DATASZ1))
+    frames = {}
+    for size in DATASZ1:
+        st = starts[valid & (nbits == size)]
+        bits = s[st[:, None] + 2 * np.arange(size)] == 4
+        check = field(bits, CHECK1[0], CHECK1[1]) == CHECK1[2]
+        frames[size] = (st[check], bits[check])
+    return frames
+
+def find_frames2(s):
+    # Frames follow the last 2 of a run of at least 8
+    n = len(s) - 2 * DATASZ2 + 1 - SYNC2_LEN
+    if n <= 0:
+        return {DATASZ2: (np.zeros(0, dtype=np.int64), np.zeros((0, DATASZ2), dtype=bool))}
+    sync = sliding_window_view(s[:-2 * DATASZ2] == 2, SYNC2_LEN).all(axis=1)
+    starts = np.flatnonzero(sync & (s[SYNC2_LEN:SYNC2_LEN + n] != 2)) + SYNC2_LEN
+    ok = np.zeros(len(s), dtype=bool)
+    ok[:-1] = (((s[:-1] == 0) & (s[1:] == 1)) |
+               ((s[:-1] == 1) & (s[1:] == 0)))
+    cs = pair_ok_cumsum(ok)
+    valid = cs[starts + 2 * DATASZ2] - cs[starts] == DATASZ2
+    st = starts[valid]
+    return {DATASZ2: (st, s[st[:, None] + 2 * np.arange(DATASZ2)] == 1)}
+
+def vote(starts, bits, npulses):
+    # Majority vote over each burst of repeated frames
+    if not len(starts):
+        return np.zeros((0, bits.shape[1]), dtype=bool), np.zeros(0, dtype=np.int64), starts
+    # A new burst starts after a gap
+    gap = np.diff(starts, prepend=-BURST_GAP - npulses) > BURST_GAP + npulses
+    first = np.flatnonzero(gap)
+    burst = np.cumsum(gap) - 1
+    nframes = np.diff(np.append(first, len(starts)))
+    counts = np.add.reduceat(bits.astype(np.int64), first, axis=0)
+    voted = counts * 2 > nframes[:, None]
+    # Then vote again without the frames that don't agree on the
+    # sensor, so that they don't count toward the other fields
+    agree = (bits[:, :SENSOR_BITS] == voted[burst, :SENSOR_BITS]).all(axis=1)
+    counts = np.add.reduceat(bits.astype(np.int64) * agree[:, None], first, axis=0)
+    nframes = np.add.reduceat(agree.astype(np.int64), first)
+    return counts * 2 > nframes[:, None], nframes, starts[first]
+
+def field(bits, first, size):
+    weights = 1 << np.arange(size - 1, -1, -1)
+    return bits[:, first:first + size].astype(np.int64) @ weights
+
+def int12(x):
+    return np.where(x & 0x800, x - 0x1000, x)
+
+def decode(s, min_frames):
+    records = []
+    for fahrenheit, frames in ((0, find_frames1(s)), (1, find_frames2(s))):
+        for size, (starts, bits) in frames.items():
+            vprint(f'{len(starts)} {size} bits dataframes of type {fahrenheit + 1}')
+            bits, nframes, pos = vote(starts, bits, 2 * size + 2)
+            keep = nframes >= min_frames
+            bits, nframes, pos = bits[keep], nframes[keep], pos[keep]
+            ident = field(bits, 0, 8)
+            channel = field(bits, 10, 2)
+            if fahrenheit:
+                # Unsigned: decidegrees Fahrenheit with a 90F offset
+                temp = field(bits, 12, 12) - 900
+                humidity = field(bits, 24, 8)
+                low_power = bits[:, 8]
+            else:
+                # Channel number coded from zero
+                channel = channel + 1
+                temp = int12(field(bits, 12, 12))
+                humidity = field(bits, 28, 8)
+                low_power = ~bits[:, 8]
+            records += zip(pos.tolist(), ident.tolist(), channel.tolist(),
+                           (temp / 10).tolist(), humidity.tolist(),
+                           low_power.tolist(), [fahrenheit] * len(pos),
+                           nframes.tolist())
+    records.sort()
+    return records
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode captured RF433 pulse logs')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="be more verbose")
+    parser.add_argument('-o', '--output', help="set output file")
+    parser.add_argument('-m', '--min-frames', type=int, default=2,
+                        help="ignore bursts of less than N agreeing frames (default: 2)")
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2,
+                        help="relative tolerance used to classify ?xxx? markers (default: 0.2)")
+    parser.add_argument('-a', '--alphabet', choices=ALPHABETS.keys(), default='protocol',
+                        help="impulse length symbols: protocol (docs/Protocol.md, sws-th-sniff) or datalog (default: protocol)")
+    parser.add_argument('ifile', nargs='*', help="input file (default: stdin)")
+    args = parser.parse_args()
+
+    global verbose
+    verbose = args.verbose
+
+    if args.output:
+        f = open(args.output, "w", encoding="utf-8")
+    else:
+        f = None
+
+    inputs = args.ifile or ['-']
+    for ifile in inputs:
+        if ifile == '-':
+            data = sys.stdin.buffer.read()
+        else:
+            with open(ifile, 'rb') as i:
+                data = i.read()
+        s = read_pulses(data, args.tolerance, args.alphabet)
+        vprint(f'{ifile}: {len(s)} impulses')
+        for pos, ident, channel, temp, humidity, lp, fahrenheit, n in decode(s, args.min_frames):
+            unit = "F" if fahrenheit else "C"
+            lp = "Low Power" if lp else ""
+            vprint(f'Impulse {pos}: {n} frames')
+            # "identifier channel temp humidity% low_power", as sws-th-client.py
+            print(f"{ident:4} {channel} {temp:8}{unit} {humidity}% {lp}", file=f)
+
+if __name__ == '__main__':
+    main()
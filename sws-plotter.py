@@ -7,6 +7,7 @@ import matplotlib
 import argparse
 import datetime as dt
 import re
+import sws_profile
 
 verbose = False
 
@@ -41,9 +42,17 @@ def main():
     parser.add_argument('-o', '--output',
                         help="set outputfile for file backend")
     
+    parser.add_argument('--profile', metavar='REPORT',
+                        help="write per stage time report as JSON ('-' for stderr)")
+    parser.add_argument('--profile-memory', action='store_true',
+                        help="also report per stage peak memory with --profile (much slower)")
+    parser.add_argument('--cprofile', metavar='FILE',
+                        help="write cProfile statistics to FILE")
     parser.add_argument('ifile', help="input file")
     args = parser.parse_args()
 
+    profiler = sws_profile.from_args(args)
+
     global verbose
     from_date = None
     to_date = None
@@ -80,7 +89,9 @@ def main():
                 configsensors[(m.group(1), m.group(2))] = m.group(3);
                 vprint(f'Named sensor: {m.group(3)}')
 
-    with open(args.ifile, 'r', encoding="utf-8") as f:
+    # Per row steps are too short to be timed apart: the profiler would
+    # mostly measure itself
+    with open(args.ifile, 'r', encoding="utf-8") as f, profiler.stage('parse'):
         l = re.compile(r'(\d{4}-\d\d-\d\d \d\d:\d\d)\s*(\d* \d)\s*(-?\d*.\d)C (\d*)%')
         s = re.compile(r'(\d*) (\d)')
         for line in f:
@@ -116,37 +127,38 @@ def main():
             sensors[sensor]['temp'][time] = float(m.group(3))
             sensors[sensor]['humidity'][time] = float(m.group(4))
 
-    plt.rcParams["figure.figsize"] = (8,12)
-    fig, axs = plt.subplots(2, 1)
-    axs[0].set_ylabel('T°C')
-    axs[0].set_ylim(bottom=-10, top=40)
-    axs[0].yaxis.set_minor_locator(matplotlib.ticker.AutoMinorLocator(5))
-    axs[0].xaxis.set_minor_locator(matplotlib.ticker.AutoMinorLocator(6))
-    axs[0].grid(which='major', alpha=0.5)
-    axs[0].grid(which='minor', alpha=0.2, linestyle=':')
-    axs[1].set_ylabel('Hum. %')
-    axs[1].set_ylim(bottom=0, top=100)
-    axs[1].yaxis.set_minor_locator(matplotlib.ticker.AutoMinorLocator(4))
-    axs[1].xaxis.set_minor_locator(matplotlib.ticker.AutoMinorLocator(6))
-    axs[1].grid(which='major', alpha=0.5)
-    axs[1].grid(which='minor', alpha=0.2, linestyle=':')
-    for sensor in configsensors.values():
-        vprint(f'Processing sensor: {sensor}')
-        if sensor not in sensors:
-            vprint(f'No data from sensor {sensor}: skip')
-            continue
-        s = sensors[sensor]
-        axs[0].plot(list(s['temp'].keys()),
-                    list(s['temp'].values()), label = 'T°C ' + sensor)
-        axs[1].plot(list(s['humidity'].keys()),
-                    list(s['humidity'].values()), label = 'Hum % ' + sensor)
-
-    axs[0].legend()
-    axs[1].legend()
-
-    if args.output:
-        plt.savefig(args.output)
-    else:
+    with profiler.stage('render'):
+        plt.rcParams["figure.figsize"] = (8,12)
+        fig, axs = plt.subplots(2, 1)
+        axs[0].set_ylabel('T°C')
+        axs[0].set_ylim(bottom=-10, top=40)
+        axs[0].yaxis.set_minor_locator(matplotlib.ticker.AutoMinorLocator(5))
+        axs[0].xaxis.set_minor_locator(matplotlib.ticker.AutoMinorLocator(6))
+        axs[0].grid(which='major', alpha=0.5)
+        axs[0].grid(which='minor', alpha=0.2, linestyle=':')
+        axs[1].set_ylabel('Hum. %')
+        axs[1].set_ylim(bottom=0, top=100)
+        axs[1].yaxis.set_minor_locator(matplotlib.ticker.AutoMinorLocator(4))
+        axs[1].xaxis.set_minor_locator(matplotlib.ticker.AutoMinorLocator(6))
+        axs[1].grid(which='major', alpha=0.5)
+        axs[1].grid(which='minor', alpha=0.2, linestyle=':')
+        for sensor in configsensors.values():
+            vprint(f'Processing sensor: {sensor}')
+            if sensor not in sensors:
+                vprint(f'No data from sensor {sensor}: skip')
+                continue
+            s = sensors[sensor]
+            axs[0].plot(list(s['temp'].keys()),
+                        list(s['temp'].values()), label = 'T°C ' + sensor)
+            axs[1].plot(list(s['humidity'].keys()),
+                        list(s['humidity'].values()), label = 'Hum % ' + sensor)
+
+        axs[0].legend()
+        axs[1].legend()
+
+        if args.output:
+            plt.savefig(args.output)
+    if not args.output:
         plt.show()
 
 
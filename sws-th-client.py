@@ -14,6 +14,17 @@ from apscheduler.triggers.cron import CronTrigger
 import argparse
 import socket
 import threading
+import http.server
+import urllib.parse
+import json
+import hashlib
+import email.utils
+import bisect
+import glob
+import lzma
+import re
+from collections import OrderedDict
+import sws_profile
 
 bus = None
 mainloop = None
@@ -41,6 +52,11 @@ meteodata_chrc = None
 HOST = "127.0.0.0"
 PORT = 12345
 
+# HTTP JSON server, disabled unless a port is given
+CACHE_SIZE = 64
+# Largest /series step: a year, in minutes
+MAX_STEP = 366 * 24 * 60
+
 # Output file
 ofile = None
 verbose = False
@@ -49,10 +65,29 @@ def vprint(*args, **kwargs):
     if verbose:
         print(*args, **kwargs)
 
+profiler = sws_profile.Profiler()
+
 # Dictionnary: key is a tuple (identifier, channel, unit)
 # value is a tuple (temperature, humidity, timestamp, low_power)
 meteodata = {}
 
+# History of the rows written to the output file (and its archives)
+# Dictionnary: key is a tuple (identifier, channel)
+# value is a tuple of lists (timestamps, temperatures, humidities)
+history = {}
+LOG_LINE = re.compile(r'(\d{4}-\d\d-\d\d \d\d:\d\d)\s*(\d*) (\d)\s*(-?\d*.\d)C (\d*)%')
+
+# Protects meteodata, history and the query cache. Generations are
+# bumped on every change, so that cached replies can be invalidated
+data_lock = threading.Lock()
+latest_generation = 0
+latest_modified = datetime.datetime.now()
+history_generation = 0
+history_modified = datetime.datetime.now()
+# LRU cache: key is a tuple (path, query)
+# value is a tuple (generation, etag, last_modified, body)
+query_cache = OrderedDict()
+
 def get_managed_objects():
     bus = dbus.SystemBus()
     manager = dbus.Interface(bus.get_object(BLUEZ_SVC, "/"), DBUS_OM_IFACE)
@@ -112,10 +147,20 @@ def meteodata_changed_cb(iface, changed_props, invalidated_props):
 
     vprint("Sensor ", entry[1], " channel ", entry[2], " : ",
            entry[0]/10, tunit, entry[3], "% ", lp)
-    meteodata[(entry[1],entry[2],entry[4])] = (entry[0]/10, entry[3], date, lp)
+    global latest_generation, latest_modified
+    with data_lock:
+        meteodata[(entry[1],entry[2],entry[4])] = (entry[0]/10, entry[3], date, lp)
+        latest_generation += 1
+        latest_modified = date
     #vprint(meteodata)
 
 
+def profiled_meteodata_changed_cb(iface, changed_props, invalidated_props):
+    # Keep a rolling histogram of the callback latency
+    with profiler.stage('callback', histogram=True):
+        meteodata_changed_cb(iface, changed_props, invalidated_props)
+
+
 def start_client():
     global prop_iface_sig
     # Listen to PropertiesChanged signals from the Heart Measurement
@@ -123,7 +168,7 @@ def start_client():
     vprint("Connect to changed properties:")
     prop_iface = dbus.Interface(meteodata_chrc[0], DBUS_PROP_IFACE)
     prop_iface_sig = prop_iface.connect_to_signal("PropertiesChanged",
-                                                  meteodata_changed_cb)
+                                                  profiled_meteodata_changed_cb)
 
     # Subscribe to Heart Rate Measurement notifications.
     vprint("Start notifications:")
@@ -211,22 +256,68 @@ def convertFtoC(temp):
     return round((temp - 32) / 1.8, 1);
 
 
+def add_history(date, ident, channel, temp, humidity):
+    times, temps, hums = history.setdefault((ident, channel), ([], [], []))
+    times.append(date)
+    temps.append(temp)
+    hums.append(humidity)
+
+
+def load_history(fname):
+    # Archives made by sws-archive.py first, they hold the oldest data
+    files = sorted(glob.glob(glob.escape(fname) + '.*.xz')) + [fname]
+    for f in files:
+        vprint("Loading history: " + f)
+        try:
+            if f.endswith('.xz'):
+                lines = lzma.open(f, 'rt', encoding="utf-8")
+            else:
+                lines = open(f, 'r', encoding="utf-8")
+        except FileNotFoundError:
+            continue
+        with lines:
+            for line in lines:
+                m = LOG_LINE.match(line)
+                if not m:
+                    continue
+                add_history(datetime.datetime.fromisoformat(m.group(1)),
+                            int(m.group(2)), int(m.group(3)),
+                            float(m.group(4)), int(m.group(5)))
+    for times, temps, hums in history.values():
+        order = sorted(range(len(times)), key=times.__getitem__)
+        times[:] = [times[i] for i in order]
+        temps[:] = [temps[i] for i in order]
+        hums[:] = [hums[i] for i in order]
+
+
 def update_data():
+    global history_generation, history_modified
     date = datetime.datetime.now()
     vprint("Regular update: " + date.strftime(DATE_FMT))
     vprint(meteodata)
-    for key, value in meteodata.items():
-        # Ignore outdated data
-        if date - value[2] < datetime.timedelta(minutes=5):
-            fahrenheit = key[2]
-            # Use celsius data when available, fahrenheit otherwise
-            if (fahrenheit == 0 or
-                ((key[0], key[1], 0) not in meteodata.keys())):
-                temp = value[0]
-                if fahrenheit == 1:
-                    temp = convertFtoC(temp)
-                ofile.write(date.strftime(DATE_FMT) +
-                            f"{key[0]:4} {key[1]} {temp:8}C {value[1]}%\n")
+    new_rows = False
+    with data_lock, profiler.stage('write'):
+        for key, value in meteodata.items():
+            # Ignore outdated data
+            if date - value[2] < datetime.timedelta(minutes=5):
+                fahrenheit = key[2]
+                # Use celsius data when available, fahrenheit otherwise
+                if (fahrenheit == 0 or
+                    ((key[0], key[1], 0) not in meteodata.keys())):
+                    temp = value[0]
+                    if fahrenheit == 1:
+                        temp = convertFtoC(temp)
+                    ofile.write(date.strftime(DATE_FMT) +
+                                f"{key[0]:4} {key[1]} {temp:8}C {value[1]}%\n")
+                    # Keep the minute resolution of the output file
+                    add_history(date.replace(second=0, microsecond=0),
+                                key[0], key[1], temp, value[1])
+                    new_rows = True
+        # Drop cached replies built from the previous rows
+        if new_rows:
+            history_generation += 1
+            history_modified = date
+            query_cache.clear()
 
 def accept_connections(s):
     while True:
@@ -247,18 +338,230 @@ def accept_connections(s):
         c.send(message.encode())
         c.close()
 
+def parse_sensor(params):
+    # sensor=identifier,channel
+    if 'sensor' not in params:
+        raise ValueError("missing sensor parameter")
+    ident, _, channel = params['sensor'][0].partition(',')
+    return (int(ident), int(channel))
+
+
+def parse_date(s):
+    date = datetime.datetime.fromisoformat(s)
+    # History is in naive local time
+    if date.tzinfo is not None:
+        date = date.astimezone().replace(tzinfo=None)
+    return date
+
+
+def parse_range(params):
+    from_date = None
+    to_date = None
+    if 'from' in params:
+        from_date = parse_date(params['from'][0])
+    if 'to' in params:
+        to_date = parse_date(params['to'][0])
+    return from_date, to_date
+
+
+def history_range(sensor, from_date, to_date):
+    # Copy the rows, so that they can be processed without the lock
+    with data_lock:
+        times, temps, hums = history.get(sensor, ([], [], []))
+        lo = bisect.bisect_left(times, from_date) if from_date else 0
+        hi = bisect.bisect_right(times, to_date) if to_date else len(times)
+        return times[lo:hi], temps[lo:hi], hums[lo:hi]
+
+
+def query_latest(params):
+    reply = []
+    with data_lock:
+        items = list(meteodata.items())
+    for key, value in items:
+        reply.append({'ident': key[0], 'channel': key[1],
+                      'unit': "F" if key[2] == 1 else "C",
+                      'temp': value[0], 'humidity': value[1],
+                      'time': value[2].strftime(DATE_FMT),
+                      'low_power': value[3] != ""})
+    return reply
+
+
+def query_series(params):
+    sensor = parse_sensor(params)
+    from_date, to_date = parse_range(params)
+    step = int(params.get('step', ['15'])[0])
+    if step <= 0 or step > MAX_STEP:
+        raise ValueError(f"step must be between 1 and {MAX_STEP} minutes")
+    step = datetime.timedelta(minutes=step)
+    times, temps, hums = history_range(sensor, from_date, to_date)
+
+    # Average the rows falling in each step
+    points = []
+    epoch = datetime.datetime(1970, 1, 1)
+    bucket = None
+    for time, temp, hum in zip(times, temps, hums):
+        b = (time - epoch) // step
+        if b != bucket:
+            if bucket is not None:
+                points.append(point)
+            bucket = b
+            point = [epoch + b * step, 0, 0, 0]
+        point[1] += temp
+        point[2] += hum
+        point[3] += 1
+    if bucket is not None:
+        points.append(point)
+
+    return {'sensor': f"{sensor[0]},{sensor[1]}",
+            'step': int(step.total_seconds()) // 60,
+            'points': [{'time': p[0].strftime(DATE_FMT),
+                        'temp': round(p[1] / p[3], 1),
+                        'humidity': round(p[2] / p[3], 1)}
+                       for p in points]}
+
+
+def query_summary(params):
+    from_date, to_date = parse_range(params)
+    if 'sensor' in params:
+        sensors = [parse_sensor(params)]
+    else:
+        with data_lock:
+            sensors = sorted(history.keys())
+    reply = []
+    for sensor in sensors:
+        times, temps, hums = history_range(sensor, from_date, to_date)
+        if not times:
+            continue
+        reply.append({'sensor': f"{sensor[0]},{sensor[1]}",
+                      'count': len(times),
+                      'first': times[0].strftime(DATE_FMT),
+                      'last': times[-1].strftime(DATE_FMT),
+                      'temp': {'min': min(temps), 'max': max(temps),
+                               'mean': round(sum(temps) / len(temps), 1)},
+                      'humidity': {'min': min(hums), 'max': max(hums),
+                                   'mean': round(sum(hums) / len(hums), 1)}})
+    return reply
+
+
+# Routes: path -> (handler, uses history)
+routes = {
+    '/latest':  (query_latest, False),
+    '/series':  (query_series, True),
+    '/summary': (query_summary, True),
+}
+
+
+def cached_query(path, query):
+    handler, from_history = routes[path]
+    key = (path, query)
+    with data_lock:
+        if from_history:
+            generation = history_generation
+            modified = history_modified
+        else:
+            generation = latest_generation
+            modified = latest_modified
+        entry = query_cache.get(key)
+        if entry and entry[0] == generation:
+            query_cache.move_to_end(key)
+            return entry[1:]
+
+    # Build the reply without the lock, not to delay the D-Bus callback
+    body = json.dumps(handler(urllib.parse.parse_qs(query))).encode()
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    last_modified = email.utils.formatdate(modified.timestamp(),
+                                           usegmt=True)
+    with data_lock:
+        current = history_generation if from_history else latest_generation
+        # Don't cache a reply made from data that changed meanwhile
+        if current == generation:
+            query_cache[key] = (generation, etag, last_modified, body)
+            if len(query_cache) > CACHE_SIZE:
+                query_cache.popitem(last=False)
+    return etag, last_modified, body
+
+
+class QueryHandler(http.server.BaseHTTPRequestHandler):
+    def send_body(self, code, body, headers={}):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for h, v in headers.items():
+            self.send_header(h, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path not in routes:
+            self.send_body(404, json.dumps({'error': "not found"}).encode())
+            return
+        try:
+            etag, last_modified, body = cached_query(url.path, url.query)
+        except (ValueError, TypeError, OverflowError) as e:
+            self.send_body(400, json.dumps({'error': str(e)}).encode())
+            return
+
+        headers = {'ETag': etag, 'Last-Modified': last_modified,
+                   'Cache-Control': 'no-cache'}
+        if self.not_modified(etag, last_modified):
+            self.send_response(304)
+            for h, v in headers.items():
+                self.send_header(h, v)
+            self.end_headers()
+            return
+        self.send_body(200, body, headers)
+
+    def not_modified(self, etag, last_modified):
+        inm = self.headers.get('If-None-Match')
+        if inm:
+            return etag in [t.strip() for t in inm.split(',')] or inm == '*'
+        ims = self.headers.get('If-Modified-Since')
+        if ims:
+            try:
+                since = email.utils.parsedate_to_datetime(ims)
+            except (TypeError, ValueError):
+                return False
+            # RFC 5322 -0000 zone: naive, but HTTP dates are all GMT
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=datetime.timezone.utc)
+            return email.utils.parsedate_to_datetime(last_modified) <= since
+        return False
+
+    def log_message(self, format, *args):
+        vprint("HTTP: " + format % args)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Read Meteodata')
     parser.add_argument('-o', '--output',
                         help='output file (default: stdout)')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help="be more berbose")
+    parser.add_argument('-p', '--http-port', type=int,
+                        help='serve JSON queries over HTTP on this port (default: disabled); history is read from the output file, without -o only rows written since startup are served')
+    parser.add_argument('--profile', metavar='REPORT',
+                        help="write per stage time report as JSON at exit and on SIGUSR1 ('-' for stderr)")
+    parser.add_argument('--cprofile', metavar='FILE',
+                        help="write cProfile statistics of the main (D-Bus) thread to FILE")
+    # No --profile-memory: callbacks, scheduler and servers run in
+    # several threads, see sws_profile.py
     args = parser.parse_args()
 
     global verbose
     verbose = args.verbose
+    global profiler
+    profiler = sws_profile.from_args(args)
+    # Never exits on its own: report on SIGUSR1
+    profiler.dump_on_signal()
     global ofile
+    if args.http_port and not args.output:
+        print("Warning: no output file, HTTP history starts now",
+              file=sys.stderr)
     if args.output:
+        if args.http_port:
+            with profiler.stage('read'):
+                load_history(args.output)
         ofile = open(args.output, 'a', encoding="utf-8", buffering=1)
     else:
         ofile = sys.stdout
@@ -289,6 +592,12 @@ def main():
     socket_thread = threading.Thread(target=accept_connections, args=(s,))
     socket_thread.start()
 
+    if args.http_port:
+        httpd = http.server.ThreadingHTTPServer((HOST, args.http_port),
+                                                QueryHandler)
+        http_thread = threading.Thread(target=httpd.serve_forever)
+        http_thread.start()
+
     while(True):
         vprint('Getting objects...')
         objects = get_managed_objects()
@@ -0,0 +1,193 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (c) 2024 Jerome Marchand
+
+# Per stage profiling shared by the sws-* scripts, it has to be
+# installed next to them. cProfile and tracemalloc are only imported
+# when asked for, profiling off costs a method call per stage.
+#
+# Memory peaks come from tracemalloc, which is process wide and slows
+# down allocation heavy code a lot: it is only enabled on request
+# (--profile-memory) and never in multi-threaded programs.
+
+import atexit
+import collections
+import json
+import signal
+import sys
+import threading
+import time
+
+# Number of latencies kept for the rolling histograms
+HISTOGRAM_LEN = 1000
+# Histogram buckets upper bounds in microseconds: 16us to ~1s
+HISTOGRAM_BOUNDS = [2 ** i for i in range(4, 21)]
+
+def from_args(args):
+    profiler = Profiler(args.profile, args.cprofile,
+                        getattr(args, 'profile_memory', False))
+    profiler.start()
+    if profiler.enabled:
+        atexit.register(profiler.write, final=True)
+    return profiler
+
+# Stage being timed. Time spent in nested stages is not accounted to
+# the parent stage.
+class Frame:
+    def __init__(self, name):
+        self.name = name
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.child_wall = 0
+        self.child_cpu = 0
+        self.peak = 0
+
+class Stats:
+    def __init__(self, histogram):
+        self.count = 0
+        self.wall = 0
+        self.cpu = 0
+        self.peak = 0
+        if histogram:
+            self.latencies = collections.deque(maxlen=HISTOGRAM_LEN)
+        else:
+            self.latencies = None
+
+class Profiler:
+    def __init__(self, report=None, cprofile=None, memory=False):
+        self.report_file = report
+        self.cprofile_file = cprofile
+        self.memory = bool(report and memory)
+        self.enabled = bool(report or cprofile)
+        self.stats = {}
+        # Reentrant: the report may be written from a signal handler
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.cprofile = None
+        self.tracemalloc = None
+
+    def start(self):
+        if self.memory:
+            import tracemalloc
+            self.tracemalloc = tracemalloc
+            tracemalloc.start()
+        # Only profiles the calling (main) thread
+        if self.cprofile_file:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def stage(self, name, histogram=False):
+        if not self.report_file:
+            return NullStage
+        return Stage(self, name, histogram)
+
+    def enter(self, name):
+        stack = self.local.__dict__.setdefault('stack', [])
+        if self.memory:
+            peak = self.tracemalloc.get_traced_memory()[1]
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            self.tracemalloc.reset_peak()
+        stack.append(Frame(name))
+
+    def leave(self, histogram):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        stack = self.local.stack
+        frame = stack.pop()
+        total_wall = wall - frame.wall
+        total_cpu = cpu - frame.cpu
+        peak = frame.peak
+        if self.memory:
+            peak = max(peak, self.tracemalloc.get_traced_memory()[1])
+        if stack:
+            stack[-1].child_wall += total_wall
+            stack[-1].child_cpu += total_cpu
+            stack[-1].peak = max(stack[-1].peak, peak)
+        with self.lock:
+            s = self.stats.get(frame.name)
+            if not s:
+                s = self.stats[frame.name] = Stats(histogram)
+            s.count += 1
+            s.wall += total_wall - frame.child_wall
+            s.cpu += total_cpu - frame.child_cpu
+            s.peak = max(s.peak, peak)
+            if s.latencies is not None:
+                s.latencies.append(total_wall)
+
+    def report(self):
+        stages = {}
+        with self.lock:
+            for name, s in self.stats.items():
+                stages[name] = {'count': s.count,
+                                'wall': round(s.wall, 6),
+                                'cpu': round(s.cpu, 6)}
+                if self.memory:
+                    stages[name]['peak_memory'] = s.peak
+                if s.latencies:
+                    stages[name]['latency'] = histogram(s.latencies)
+        return {'argv': sys.argv,
+                'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                # tracemalloc inflates wall and cpu times when on
+                'memory_traced': self.memory,
+                'stages': stages}
+
+    def write(self, final=False):
+        if self.report_file:
+            report = json.dumps(self.report(), indent=2) + '\n'
+            if self.report_file == '-':
+                sys.stderr.write(report)
+            else:
+                with open(self.report_file, 'w', encoding="utf-8") as f:
+                    f.write(report)
+        if self.cprofile:
+            # Stops the profiler
+            self.cprofile.dump_stats(self.cprofile_file)
+            if not final:
+                self.cprofile.enable()
+
+    def dump_on_signal(self, signum=signal.SIGUSR1):
+        if self.enabled:
+            signal.signal(signum, lambda signum, frame: self.write())
+
+class Stage:
+    def __init__(self, profiler, name, histogram):
+        self.profiler = profiler
+        self.name = name
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.profiler.enter(self.name)
+
+    def __exit__(self, *exc):
+        self.profiler.leave(self.histogram)
+        return False
+
+# Returned by stage() when profiling is off: does nothing
+class _NullStage:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        return False
+
+NullStage = _NullStage()
+
+def histogram(latencies):
+    l = sorted(latencies)
+    buckets = collections.OrderedDict()
+    i = 0
+    for bound in HISTOGRAM_BOUNDS:
+        n = 0
+        while i < len(l) and l[i] * 1e6 <= bound:
+            n += 1
+            i += 1
+        buckets[f'<={bound}us'] = n
+    buckets[f'>{HISTOGRAM_BOUNDS[-1]}us'] = len(l) - i
+    return {'count': len(l),
+            'min': l[0], 'max': l[-1],
+            'mean': sum(l) / len(l),
+            'p50': l[len(l) // 2],
+            'p90': l[len(l) * 9 // 10],
+            'p99': l[len(l) * 99 // 100],
+            'buckets': buckets}